@@ -1,13 +1,47 @@
 import streamlit as st
-import google.generativeai as genai
-import json
+import hashlib
+import logging
+import orjson
 import os
+import queue
+import random
+import sqlite3
+import tempfile
+import threading
 import time
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime
+from urllib.parse import quote, unquote
+
+# Heavy SDKs (google.generativeai, pymupdf, numpy) are imported inside the functions
+# that use them, so the login page doesn't pay for them on a cold start.
 
 # --- CONFIGURATION ---
-DATA_FILE = "user_data.json"
+DB_FILE = "analyst.db"
+HISTORY_DIR = "history"
+LEGACY_DATA_FILE = "user_data.json"  # original {email: {"history", "credits_used"}} store
+LEGACY_HISTORY_FILE = "history.jsonl"  # shared log used before per-user logs
+FLUSH_SECONDS = 0.2
+FLUSH_BATCH = 32
+FLUSH_RETRIES = 5
+UPLOAD_INDEX_FILE = "upload_index.json"
+UPLOAD_TTL = 47 * 3600  # Gemini deletes uploaded files after 48h
 FREE_LIMIT = 5
+CHUNK_CHARS = 3200  # roughly 800 tokens
+TOP_K = 5
+RETRIEVAL_MIN_CHARS = 40000  # shorter documents are sent whole to the vision model
+EMBED_MODEL = "models/text-embedding-004"
+MAX_RETRIES = 3
+RETRY_BASE_SECONDS = 10
+RPM_LIMIT = 15  # Gemini requests per minute shared by every session
+EMBED_RPM_LIMIT = 100  # embeddings have their own, larger quota
+CONCURRENCY_MIN = 1
+CONCURRENCY_MAX = 8
+LATENCY_TARGET = 15.0  # seconds
+BREAKER_SECONDS = 30
+
+logger = logging.getLogger(__name__)
 
 st.set_page_config(
     page_title="Gemini Pro Analyst",
@@ -16,66 +50,508 @@ st.set_page_config(
 )
 
 # --- BACKEND FUNCTIONS ---
-def load_data():
-    if os.path.exists(DATA_FILE):
-        with open(DATA_FILE, "r") as f:
-            return json.load(f)
+# Each write changes mtime_ns, so only the latest few parses are worth keeping.
+@st.cache_data(show_spinner=False, max_entries=4)
+def load_data_cached(path, mtime_ns):
+    try:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    except (OSError, ValueError):
+        logger.warning("Ignoring unreadable %s", path)
+        return {}
+
+def load_data(path):
+    # Keyed on mtime so a write invalidates the cached parse.
+    if os.path.exists(path):
+        return load_data_cached(path, os.stat(path).st_mtime_ns)
     return {}
 
-def save_data(data):
-    with open(DATA_FILE, "w") as f:
-        json.dump(data, f, indent=4)
+def save_data(data, path):
+    # Write a sibling temp file and swap it in, so readers never see a partial file.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def history_path(email):
+    return os.path.join(HISTORY_DIR, f"{quote(email, safe='@')}.jsonl")
+
+@st.cache_resource
+def get_history_lock():
+    return threading.Lock()
+
+def append_history(email, entry):
+    # Returns the byte offset of the new line, which keys its database row.
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    with get_history_lock(), open(history_path(email), "a+b") as f:
+        pos = f.seek(0, os.SEEK_END)
+        if pos:
+            # Start on a fresh line if a crash left the last append torn.
+            f.seek(pos - 1)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+                pos += 1
+        f.write(orjson.dumps(entry, option=orjson.OPT_APPEND_NEWLINE))
+    return pos
+
+def history_row(email, entry):
+    ts = int(datetime.strptime(entry["time"], "%Y-%m-%d %H:%M").timestamp())
+    return email, ts, entry["doc"], entry["q"], entry["a"]
+
+def migrate_legacy_history():
+    # One-time move of the older JSON stores into the per-user logs. Every saved
+    # answer cost a credit there too, so the imported rows carry the credit counts over.
+    entries = []
+    if os.path.exists(LEGACY_DATA_FILE):
+        for email, record in load_data(LEGACY_DATA_FILE).items():
+            entries.extend((email, entry) for entry in record["history"])
+    if os.path.exists(LEGACY_HISTORY_FILE):
+        with open(LEGACY_HISTORY_FILE, "rb") as f:
+            for line in f:
+                try:
+                    entry = orjson.loads(line)
+                    entries.append((entry.pop("email"), entry))
+                except (ValueError, KeyError):
+                    logger.warning("Skipping unreadable line in %s", LEGACY_HISTORY_FILE)
+    for email, entry in entries:
+        append_history(email, entry)
+    for path in (LEGACY_DATA_FILE, LEGACY_HISTORY_FILE):
+        if os.path.exists(path):
+            os.replace(path, f"{path}.migrated")
+
+# (email, pos) is unique, so replaying a row the writer already stored is a no-op.
+INSERT_CHAT = "INSERT OR IGNORE INTO chat(email, ts, doc, q, a, pos) VALUES (?, ?, ?, ?, ?, ?)"
+
+def logged_history():
+    # The per-user logs are the source of truth; each row is keyed by its line's byte offset.
+    rows = []
+    if not os.path.isdir(HISTORY_DIR):
+        return rows
+    for name in os.listdir(HISTORY_DIR):
+        email = unquote(name.removesuffix(".jsonl"))
+        pos = 0
+        with open(os.path.join(HISTORY_DIR, name), "rb") as f:
+            for line in f:
+                try:
+                    rows.append((*history_row(email, orjson.loads(line)), pos))
+                except (ValueError, KeyError):
+                    logger.warning("Skipping unreadable history line at byte %d of %s", pos, name)
+                pos += len(line)
+    return rows
+
+@st.cache_resource
+def get_db():
+    # One connection per process, opened and migrated once. Sessions run on
+    # separate threads, so every use goes through the returned lock.
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("CREATE TABLE IF NOT EXISTS chat(email TEXT, ts INT, doc TEXT, q TEXT, a TEXT, pos INT)")
+    if "pos" not in [column[1] for column in conn.execute("PRAGMA table_info(chat)")]:
+        # Rows from before offsets were tracked: where a log exists it holds them all,
+        # so drop them and let the sync below re-insert them with their offsets.
+        conn.execute("ALTER TABLE chat ADD COLUMN pos INT")
+        logged = [(unquote(name.removesuffix(".jsonl")),) for name in os.listdir(HISTORY_DIR)] if os.path.isdir(HISTORY_DIR) else []
+        conn.executemany("DELETE FROM chat WHERE email = ? AND pos IS NULL", logged)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_email_ts ON chat(email, ts DESC)")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_email_pos ON chat(email, pos)")
+    migrate_legacy_history()
+    # Inserts whatever never reached the database: a fresh file, writes still queued
+    # when a process stopped, or batches the writer gave up on.
+    with conn:
+        conn.executemany(INSERT_CHAT, logged_history())
+    return conn, threading.Lock()
+
+class ChatWriter:
+    """Background thread that batches chat rows into the database."""
+
+    def __init__(self, conn, lock):
+        self.conn = conn
+        self.lock = lock
+        self.queue = queue.Queue()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def put(self, row):
+        self.queue.put(row)
+
+    def run(self):
+        # Flush every FLUSH_SECONDS or FLUSH_BATCH rows, whichever comes first.
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + FLUSH_SECONDS
+            while len(batch) < FLUSH_BATCH:
+                try:
+                    batch.append(self.queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            try:
+                self.flush(batch)
+            except Exception:
+                # Never let the thread die. The rows are still in the history logs
+                # and get_db() syncs them on the next start.
+                logger.exception("Dropped %d chat rows after a database error", len(batch))
+
+    def flush(self, batch):
+        for attempt in range(FLUSH_RETRIES):
+            try:
+                with self.lock, self.conn:
+                    self.conn.executemany(INSERT_CHAT, batch)
+                return
+            except sqlite3.OperationalError:
+                # Usually a busy/locked database; give up once it looks permanent.
+                if attempt == FLUSH_RETRIES - 1:
+                    raise
+                time.sleep(FLUSH_SECONDS * 2 ** attempt)
+
+@st.cache_resource
+def get_chat_writer():
+    return ChatWriter(*get_db())
 
 def save_chat_history(email, doc_name, question, answer):
-    data = load_data()
-    if email not in data:
-        data[email] = {"history": [], "credits_used": 0}
-    
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M")
-    entry = {"time": timestamp, "doc": doc_name, "q": question, "a": answer}
-    data[email]["history"].append(entry)
-    data[email]["credits_used"] += 1
-    save_data(data)
+    # The log append is synchronous for durability; the database row is written behind.
+    writer = get_chat_writer()
+    ts = int(time.time())
+    entry = {"time": datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M"), "doc": doc_name, "q": question, "a": answer}
+    pos = append_history(email, entry)
+    writer.put((email, ts, doc_name, question, answer, pos))
+
+@st.cache_resource
+def get_credit_ledger():
+    # Credits per email for this process: every tab of a user draws on one count,
+    # and answers still queued for the database are already included.
+    return {}, threading.RLock()
 
 def get_user_stats(email):
-    data = load_data()
-    if email in data:
-        return data[email]["credits_used"], data[email]["history"]
-    return 0, []
+    # Every saved answer costs one credit, so the row count is the credit count.
+    ledger, lock = get_credit_ledger()
+    with lock:
+        if email not in ledger:
+            conn, db_lock = get_db()
+            with db_lock:
+                (ledger[email],) = conn.execute("SELECT COUNT(*) FROM chat WHERE email = ?", (email,)).fetchone()
+        return ledger[email]
+
+def reserve_credit(email):
+    # Claimed before asking, so concurrent tabs can't spend past the limit.
+    ledger, lock = get_credit_ledger()
+    with lock:
+        if get_user_stats(email) >= FREE_LIMIT:
+            return False
+        ledger[email] += 1
+        return True
+
+def refund_credit(email):
+    ledger, lock = get_credit_ledger()
+    with lock:
+        ledger[email] -= 1
+
+# --- TEXT ENGINE ---
+@st.cache_data(show_spinner=False, max_entries=32)
+def extract_text(data_bytes):
+    import pymupdf
 
-# --- NEW: VISION ENGINE ---
-def upload_to_gemini(uploaded_file):
     try:
-        with open("temp_doc.pdf", "wb") as f:
-            f.write(uploaded_file.getvalue())
-        vision_file = genai.upload_file("temp_doc.pdf")
-        return vision_file
-    except Exception as e:
-        st.error(f"Upload failed: {e}")
+        doc = pymupdf.open(stream=data_bytes, filetype="pdf")
+    except pymupdf.FileDataError:
+        return None
+    if doc.needs_pass:
         return None
+    # Kept serial: MuPDF is not thread-safe and holds the GIL, and Streamlit swaps
+    # sys.modules["__main__"] for this script, so spawned worker processes would re-run the app.
+    return "\n".join(page.get_text("text") for page in doc)
+
+def chunk_text(text, size=CHUNK_CHARS):
+    chunks, current = [], ""
+    for line in text.splitlines():
+        while len(line) > size:
+            chunks.append(line[:size])
+            line = line[size:]
+        if current and len(current) + len(line) + 1 > size:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n{line}" if current else line
+    if current.strip():
+        chunks.append(current)
+    return chunks
+
+def build_index(text):
+    import google.generativeai as genai
+    import numpy as np
+
+    chunks = chunk_text(text)
+    embeddings = []
+    for i in range(0, len(chunks), 100):  # batch limit of the embedding API
+        result = call_gemini(lambda: genai.embed_content(
+            model=EMBED_MODEL, content=chunks[i:i + 100], task_type="retrieval_document"
+        ), quota="embed")
+        embeddings.extend(result["embedding"])
+    matrix = np.array(embeddings, dtype=np.float32)
+    return chunks, matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+
+def retrieve(index, question, k=TOP_K):
+    import google.generativeai as genai
+    import numpy as np
+
+    chunks, matrix = index
+    result = call_gemini(lambda: genai.embed_content(model=EMBED_MODEL, content=question, task_type="retrieval_query"), quota="embed")
+    scores = matrix @ np.array(result["embedding"], dtype=np.float32)
+    top = np.argsort(scores)[::-1][:k]
+    return [chunks[i] for i in sorted(top)]
+
+# --- RATE LIMITING ---
+class RateWindow:
+    """Sliding one-minute window of Gemini calls made by this process."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.calls = deque()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # Block until the window has room instead of spending a request on a certain 429.
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                while self.calls and now - self.calls[0] >= 60:
+                    self.calls.popleft()
+                if len(self.calls) < self.limit:
+                    self.calls.append(now)
+                    return
+                wait_seconds = self.calls[0] + 60 - now
+            time.sleep(wait_seconds)
+
+@st.cache_resource
+def get_rate_window(quota):
+    return RateWindow(EMBED_RPM_LIMIT if quota == "embed" else RPM_LIMIT)
+
+class AdmissionController:
+    """AIMD limit on concurrent Gemini calls, shared by every session."""
+
+    def __init__(self):
+        self.limit = float(CONCURRENCY_MAX) / 2
+        self.active = 0
+        self.latency = None  # EWMA of successful call latency
+        self.open_until = 0.0
+        self.cond = threading.Condition()
 
-def ask_gemini_vision(model, vision_file, question):
-    max_retries = 3
-    for attempt in range(max_retries):
+    def acquire(self):
+        with self.cond:
+            if time.monotonic() < self.open_until:
+                return False
+            while self.active >= int(self.limit):
+                self.cond.wait()
+            self.active += 1
+            return True
+
+    def release(self, latency=None, congested=False):
+        # Pass `latency` for a successful call, `congested` for an overload error, neither for other errors.
+        with self.cond:
+            self.active -= 1
+            if congested:
+                # Still overloaded at the floor: stop calling out for a while.
+                if self.limit <= CONCURRENCY_MIN:
+                    self.open_until = time.monotonic() + BREAKER_SECONDS
+                self.limit = max(CONCURRENCY_MIN, self.limit * 0.5)
+            elif latency is not None:
+                self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+                if self.latency <= LATENCY_TARGET:
+                    self.limit = min(CONCURRENCY_MAX, self.limit + 0.5)
+            self.cond.notify_all()
+
+@st.cache_resource
+def get_admission_controller(quota):
+    return AdmissionController()
+
+def is_congestion(error):
+    # Only overload signals should shrink the shared limit; a bad file or a
+    # blocked answer from one session says nothing about Gemini's capacity.
+    from google.api_core import exceptions as google_exceptions
+
+    return isinstance(error, (
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.DeadlineExceeded,
+    ))
+
+def retry_after_seconds(error):
+    # REST responses carry a Retry-After header, gRPC errors a RetryInfo detail.
+    headers = getattr(error.response, "headers", None) or {}
+    if headers.get("retry-after"):
         try:
-            response = model.generate_content([question, vision_file])
-            return response.text
-        except Exception as e:
-            if "429" in str(e):
-                time.sleep(10)
-            else:
-                return f"Error: {e}"
-    return "System busy. Please try again."
+            return float(headers["retry-after"])
+        except ValueError:
+            pass
+    for detail in error.details:
+        if isinstance(detail, dict):
+            delay = detail.get("retryDelay")
+            if delay:
+                return float(delay.rstrip("s"))
+        elif hasattr(detail, "retry_delay"):
+            return detail.retry_delay.seconds + detail.retry_delay.nanos / 1e9
+    return None
+
+class GeminiBusy(Exception):
+    """Gemini stayed rate limited, or the admission breaker is open."""
+
+@contextmanager
+def admitted(quota="generate"):
+    # Wait for the RPM window before taking a slot, so a blocked session doesn't hold one idle.
+    # Embedding calls are limited separately, so they neither use up nor throttle chat answers.
+    get_rate_window(quota).acquire()
+    controller = get_admission_controller(quota)
+    if not controller.acquire():
+        raise GeminiBusy("System busy. Please try again.")
+    start = time.monotonic()
+    try:
+        yield
+    except Exception as e:
+        controller.release(congested=is_congestion(e))
+        raise
+    except BaseException:
+        controller.release()
+        raise
+    controller.release(latency=time.monotonic() - start)
+
+def wait_before_retry(error, attempt):
+    wait_seconds = retry_after_seconds(error)
+    if wait_seconds is None:
+        # Exponential backoff with jitter so rate-limited sessions don't retry in lockstep.
+        wait_seconds = RETRY_BASE_SECONDS * 2 ** attempt
+        wait_seconds += random.uniform(0, wait_seconds * 0.3)
+    st.toast(f"⏳ Rate limited. Retrying in {wait_seconds:.0f}s...")
+    time.sleep(wait_seconds)
+
+def call_gemini(call, quota="generate"):
+    # Runs a non-streaming Gemini call under the shared limits, retrying 429s.
+    from google.api_core import exceptions as google_exceptions
+
+    for attempt in range(MAX_RETRIES):
+        try:
+            with admitted(quota):
+                return call()
+        except google_exceptions.ResourceExhausted as e:
+            if attempt == MAX_RETRIES - 1:
+                raise GeminiBusy("System busy. Please try again.") from e
+            wait_before_retry(e, attempt)
+
+# --- NEW: VISION ENGINE ---
+def file_key(data_bytes):
+    return hashlib.blake2b(data_bytes, digest_size=16).hexdigest()
+
+def upload_to_gemini(data_bytes):
+    import google.generativeai as genai
+
+    # A private temp file per upload, so concurrent sessions can't overwrite each other's PDF.
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tf:
+        tf.write(data_bytes)
+        path = tf.name
+    try:
+        return genai.upload_file(path)
+    finally:
+        os.unlink(path)
+
+@st.cache_resource
+def get_upload_index_lock():
+    return threading.Lock()
+
+@st.cache_resource(ttl=UPLOAD_TTL, show_spinner=False)
+def get_vision_ref(key, _data_bytes):
+    import google.generativeai as genai
+
+    # Reuse an upload from a previous process if Gemini still holds it.
+    now = time.time()
+    index = {k: v for k, v in load_data(UPLOAD_INDEX_FILE).items() if now - v["uploaded"] < UPLOAD_TTL}
+    if key in index:
+        try:
+            return genai.get_file(index[key]["name"]), index[key]["uploaded"]
+        except Exception:
+            pass
+    vision_file = upload_to_gemini(_data_bytes)
+    # Re-read under the lock so concurrent uploads don't overwrite each other's entries.
+    with get_upload_index_lock():
+        index = {k: v for k, v in load_data(UPLOAD_INDEX_FILE).items() if now - v["uploaded"] < UPLOAD_TTL}
+        index[key] = {"name": vision_file.name, "uploaded": now}
+        save_data(index, UPLOAD_INDEX_FILE)
+    return vision_file, now
+
+def vision_ref(key, data_bytes):
+    # The cache TTL runs from when the handle was cached, not from the upload,
+    # so check the upload's own age before trusting a cached handle.
+    vision_file, uploaded = get_vision_ref(key, data_bytes)
+    if time.time() - uploaded >= UPLOAD_TTL:
+        get_vision_ref.clear(key, data_bytes)
+        vision_file, uploaded = get_vision_ref(key, data_bytes)
+    return vision_file
+
+@st.cache_resource
+def get_model():
+    # Configures the SDK once per process; uploads and embeddings rely on it too.
+    import google.generativeai as genai
+
+    genai.configure(api_key=st.secrets["SYSTEM_API_KEY"])
+    return genai.GenerativeModel('gemini-flash-latest')
+
+def ask_gemini(model, question, outcome):
+    from google.api_core import exceptions as google_exceptions
+
+    # Yields the answer as it streams in; a 429 is only retried before the first chunk.
+    # Error text is yielded for display too, so success is reported through outcome["ok"].
+    outcome["ok"] = False
+    try:
+        contents = build_contents(question)
+        for attempt in range(MAX_RETRIES):
+            streamed = False
+            try:
+                with admitted():
+                    for chunk in model.generate_content(contents, stream=True):
+                        streamed = True
+                        yield chunk.text
+                outcome["ok"] = True
+                return
+            except google_exceptions.ResourceExhausted as e:
+                if streamed:
+                    raise
+                if attempt == MAX_RETRIES - 1:
+                    raise GeminiBusy("System busy. Please try again.") from e
+                wait_before_retry(e, attempt)
+    except GeminiBusy as e:
+        yield str(e)
+    except Exception as e:
+        yield f"Error: {e}"
+
+def build_contents(question):
+    # Long text documents are answered from retrieved excerpts, everything else from the uploaded file.
+    if st.session_state.doc_index is None:
+        return [question, st.session_state.uploaded_file_ref]
+    excerpts = "\n\n---\n\n".join(retrieve(st.session_state.doc_index, question))
+    return [f"Answer using these excerpts from the document.\n\n{excerpts}\n\nQuestion: {question}"]
+
+def render_credits(placeholder):
+    credits_used = st.session_state.credits_used
+    with placeholder.container():
+        st.write(f"**Credits:** {credits_used}/{FREE_LIMIT}")
+        st.progress(min(credits_used / FREE_LIMIT, 1.0))
 
 # --- SESSION STATE ---
 if "logged_in" not in st.session_state:
     st.session_state.logged_in = False
 if "user_email" not in st.session_state:
     st.session_state.user_email = ""
+if "credits_used" not in st.session_state:
+    st.session_state.credits_used = 0
 if "current_chat" not in st.session_state:
     st.session_state.current_chat = []
 if "uploaded_file_ref" not in st.session_state:
     st.session_state.uploaded_file_ref = None
+if "uploaded_file_key" not in st.session_state:
+    st.session_state.uploaded_file_key = None
+if "doc_index" not in st.session_state:
+    st.session_state.doc_index = None
+if "bad_files" not in st.session_state:
+    st.session_state.bad_files = set()
 
 # --- PAGE 1: LOGIN ---
 if not st.session_state.logged_in:
@@ -93,15 +569,16 @@ if not st.session_state.logged_in:
 
 # --- PAGE 2: DASHBOARD ---
 else:
-    credits_used, history = get_user_stats(st.session_state.user_email)
-    credits_left = FREE_LIMIT - credits_used
+    # Cheap after login: read from the in-process ledger, which other tabs update too.
+    st.session_state.credits_used = get_user_stats(st.session_state.user_email)
+    credits_left = FREE_LIMIT - st.session_state.credits_used
     
     with st.sidebar:
         st.markdown("### 👤 User Profile")
         st.caption(f"Logged in as: {st.session_state.user_email}")
         st.markdown("---")
-        st.write(f"**Credits:** {credits_used}/{FREE_LIMIT}")
-        st.progress(min(credits_used / FREE_LIMIT, 1.0))
+        credits_box = st.empty()
+        render_credits(credits_box)
         
         st.markdown("<div style='height: 30vh;'></div>", unsafe_allow_html=True)
         st.markdown("---")
@@ -116,38 +593,86 @@ else:
     uploaded_file = st.file_uploader("Upload Document", type="pdf")
 
     if uploaded_file:
-        if st.session_state.uploaded_file_ref is None:
+        data_bytes = uploaded_file.getvalue()
+        key = file_key(data_bytes)
+        if key in st.session_state.bad_files:
+            st.error("Could not read this PDF. Please upload a valid file.")
+            st.stop()
+        if st.session_state.uploaded_file_key != key:
             with st.spinner("🧠 Reading document structure (Vision AI)..."):
-                if "SYSTEM_API_KEY" in st.secrets:
-                    genai.configure(api_key=st.secrets["SYSTEM_API_KEY"])
-                    vision_ref = upload_to_gemini(uploaded_file)
-                    st.session_state.uploaded_file_ref = vision_ref
-                    st.success("Document analyzed!")
+                text_content = extract_text(data_bytes)
+                if text_content is None:
+                    st.session_state.bad_files.add(key)
+                    st.error("Could not read this PDF. Please upload a valid file.")
+                    st.stop()
+                elif "SYSTEM_API_KEY" in st.secrets:
+                    get_model()
+                    try:
+                        if len(text_content) >= RETRIEVAL_MIN_CHARS:
+                            st.session_state.doc_index = build_index(text_content)
+                            st.session_state.uploaded_file_ref = None
+                        else:
+                            st.session_state.doc_index = None
+                            st.session_state.uploaded_file_ref = vision_ref(key, data_bytes)
+                        st.session_state.uploaded_file_key = key
+                        st.success("Document analyzed!")
+                    except Exception as e:
+                        # Don't leave the previous document answering questions about this one.
+                        st.session_state.uploaded_file_ref = None
+                        st.session_state.doc_index = None
+                        st.session_state.uploaded_file_key = None
+                        st.error(f"Upload failed: {e}")
+                        st.stop()
                 else:
+                    st.session_state.uploaded_file_ref = None
+                    st.session_state.doc_index = None
+                    st.session_state.uploaded_file_key = None
                     st.error("🚨 Cloud API Key missing!")
+                    st.stop()
 
-        for msg in st.session_state.current_chat:
-            icon = "👤" if msg["role"] == "user" else "✨"
-            with st.chat_message(msg["role"], avatar=icon):
-                st.markdown(msg["content"])
+        # Streamlit keeps no DOM between script runs, so earlier turns are replayed once
+        # per run; the turn being answered is only ever appended below them.
+        chat_container = st.container()
+        with chat_container:
+            for msg in st.session_state.current_chat:
+                icon = "👤" if msg["role"] == "user" else "✨"
+                st.chat_message(msg["role"], avatar=icon).markdown(msg["content"])
 
         if credits_left > 0:
             if user_question := st.chat_input("Ask about this document..."):
-                st.session_state.current_chat.append({"role": "user", "content": user_question})
-                with st.chat_message("user", avatar="👤"):
-                    st.markdown(user_question)
-
-                with st.chat_message("assistant", avatar="✨"):
-                    with st.spinner("Looking at document..."):
-                        model = genai.GenerativeModel('gemini-flash-latest')
-                        bot_reply = ask_gemini_vision(model, st.session_state.uploaded_file_ref, user_question)
-                        st.markdown(bot_reply)
-                        
-                        if "System busy" not in bot_reply:
-                            st.session_state.current_chat.append({"role": "assistant", "content": bot_reply})
-                            save_chat_history(st.session_state.user_email, uploaded_file.name, user_question, bot_reply)
-                            time.sleep(0.5)
-                            st.rerun()
+                if not reserve_credit(st.session_state.user_email):
+                    st.rerun()  # another tab used the last credit
+                # Refund unless the answer was saved, including when a rerun, stop or
+                # write error interrupts this turn. Failed answers are shown once but not kept.
+                saved = False
+                try:
+                    if st.session_state.doc_index is None:
+                        try:
+                            st.session_state.uploaded_file_ref = vision_ref(key, data_bytes)
+                        except Exception as e:
+                            st.error(f"Upload failed: {e}")
+                            st.stop()
+                    with chat_container:
+                        st.chat_message("user", avatar="👤").markdown(user_question)
+
+                    with chat_container, st.chat_message("assistant", avatar="✨"):
+                        with st.spinner("Looking at document..."):
+                            outcome = {}
+                            bot_reply = st.write_stream(ask_gemini(get_model(), user_question, outcome))
+                            if outcome["ok"] and bot_reply.strip():
+                                save_chat_history(st.session_state.user_email, uploaded_file.name, user_question, bot_reply)
+                                st.session_state.current_chat.append({"role": "user", "content": user_question})
+                                st.session_state.current_chat.append({"role": "assistant", "content": bot_reply})
+                                saved = True
+                finally:
+                    if not saved:
+                        refund_credit(st.session_state.user_email)
+
+                # The page already shows this turn; only the credit meter needs updating.
+                st.session_state.credits_used = get_user_stats(st.session_state.user_email)
+                render_credits(credits_box)
+                if st.session_state.credits_used >= FREE_LIMIT:
+                    st.rerun()  # swap the chat input for the limit notice
         else:
             st.warning("🔒 Credit limit reached.")
             st.button("Upgrade to Pro")